@@ -3,18 +3,46 @@ Simple fetch provider for ldap.
 
 This fetcher also serves as an example how to build custom OPAL Fetch Providers.
 """
+import asyncio
+import functools
 import json
-from typing import Optional, List, Dict
+import operator
+import os
+import socket
+import time
+from typing import Optional, List, Dict, Tuple
 
-from distutils.util import strtobool
-from pydantic import BaseModel, Field
-from tenacity import wait, stop, retry_unless_exception_type
+from pydantic import BaseModel, Field, validator
+from tenacity import wait, stop, retry_if_exception
 
 from opal_common.fetcher.fetch_provider import BaseFetchProvider
 from opal_common.fetcher.events import FetcherConfig, FetchEvent
 from opal_common.logger import logger
 
 import ldap3
+from ldap3.core.exceptions import LDAPException, LDAPInvalidFilterError, LDAPBindError
+from ldap3.core.results import RESULT_SIZE_LIMIT_EXCEEDED, RESULT_ADMIN_LIMIT_EXCEEDED
+
+# maximum number of bound connections (per server and credentials) used concurrently
+LDAP_POOL_SIZE = int(os.getenv("OPAL_LDAP_POOL_SIZE", "10"))
+# idle connections older than this (in seconds) are checked before they are handed out again
+LDAP_POOL_LIVENESS_CHECK_AFTER = float(os.getenv("OPAL_LDAP_POOL_LIVENESS_CHECK_AFTER", "30"))
+# idle connections older than this (in seconds) are closed, i.e. the ones of credentials that were rotated
+LDAP_POOL_MAX_IDLE = float(os.getenv("OPAL_LDAP_POOL_MAX_IDLE", "300"))
+# timeout (in seconds) for connecting to the server
+LDAP_CONNECT_TIMEOUT = float(os.getenv("OPAL_LDAP_CONNECT_TIMEOUT", "5"))
+# timeout (in seconds) for waiting on a response, unset by default: a slow search is not a dropped connection,
+# and the restartable strategy would otherwise re-run it from scratch
+LDAP_RECEIVE_TIMEOUT = float(os.environ["OPAL_LDAP_RECEIVE_TIMEOUT"]) if os.getenv("OPAL_LDAP_RECEIVE_TIMEOUT") else None
+# a pooled connection is probed by the kernel after being idle for this long (in seconds), so that firewalls and NATs
+# do not drop it silently, and a connection that was dropped anyway is detected
+LDAP_KEEPALIVE_IDLE = int(os.getenv("OPAL_LDAP_KEEPALIVE_IDLE", "60"))
+# timeout (in seconds) for the liveness check of a connection that was idle for LDAP_POOL_LIVENESS_CHECK_AFTER
+LDAP_POOL_LIVENESS_CHECK_TIMEOUT = float(os.getenv("OPAL_LDAP_POOL_LIVENESS_CHECK_TIMEOUT", "5"))
+# how often a dropped connection is reopened transparently before the fetch fails (and is retried)
+LDAP_RESTARTABLE_TRIES = int(os.getenv("OPAL_LDAP_RESTARTABLE_TRIES", "3"))
+# re-validate the whole fetch event in parse_event, not just the ldap specific config
+LDAP_VALIDATE_FETCH_EVENTS = os.getenv("OPAL_LDAP_VALIDATE_FETCH_EVENTS", "false").lower() in ("1", "true", "yes", "on")
 
 
 class LdapConnectionParams(BaseModel):
@@ -27,6 +55,33 @@ class LdapConnectionParams(BaseModel):
     url: str = Field(None, description="database host address (e.g. ldaps://localhost:636)")
 
 
+def _normalize_search(cls, value: Optional[str]) -> Optional[str]:
+    # normalized when the config is parsed, ldap3 still parses the filter for every page it requests
+    if value is None:
+        return value
+    value = value.strip()
+    if not value.startswith("("):
+        value = f"({value})"
+    return value
+
+
+def _default_attributes(cls, value: Optional[List[str]]) -> List[str]:
+    # without a list of attributes, all user attributes of the entries are fetched
+    return value if value is not None else [ldap3.ALL_ATTRIBUTES]
+
+
+class LdapSearch(BaseModel):
+    """
+    one of the searches of a data source, see `LdapFetcherConfig.searches`.
+    """
+    root: str = Field(..., description="the root dn")
+    search: str = Field(..., description="the search query")
+    attributes: List[str] = Field(None, description="list of attributes, all (user) attributes if not set")
+
+    normalize_search = validator("search", allow_reuse=True)(_normalize_search)
+    default_attributes = validator("attributes", always=True, allow_reuse=True)(_default_attributes)
+
+
 class LdapFetcherConfig(FetcherConfig):
     """
     Config for LdapFetchProvider, instance of `FetcherConfig`.
@@ -45,7 +100,19 @@ class LdapFetcherConfig(FetcherConfig):
                                                               description="these params can override or complement parts of the dsn (connection string)")
     root: str = Field(None, description="the root dn")
     search: str = Field(None, description="the search query")
-    attributes: List[str] = Field(None, description="list of attributes")
+    attributes: List[str] = Field(None, description="list of attributes, all (user) attributes if not set")
+    searches: List[LdapSearch] = Field(None,
+                                       description="further searches on the same server, they run concurrently "
+                                                   "and their entries are merged into the result")
+    cache_ttl_seconds: float = Field(0, ge=0,
+                                     description="reuse the results of an identical search (same server, credentials, "
+                                                 "root, search and attributes) for this many seconds, 0 disables this")
+    paged_size: int = Field(1000, gt=0,
+                            description="number of entries per page of the paged search, "
+                                        "halved automatically if the server rejects it")
+
+    normalize_search = validator("search", allow_reuse=True)(_normalize_search)
+    default_attributes = validator("attributes", always=True, allow_reuse=True)(_default_attributes)
 
 
 class LdapFetchEvent(FetchEvent):
@@ -59,6 +126,258 @@ class LdapFetchEvent(FetchEvent):
     config: LdapFetcherConfig = None
 
 
+# the fields copied from a FetchEvent in `LdapFetchProvider.parse_event()`, the field set is fixed,
+# so the names are looked up once and the values are read with a single call
+_EVENT_FIELDS = tuple(name for name in LdapFetchEvent.__fields__ if name != "config")
+_get_event_fields = operator.attrgetter(*_EVENT_FIELDS)
+
+
+@functools.lru_cache(maxsize=512)
+def _parse_fetcher_config(config_json: str) -> LdapFetcherConfig:
+    """
+    OPAL sends the same data source entries with every update, so the parsed configs are cached.
+    the cached configs are shared between fetch events and must not be modified.
+    """
+    return LdapFetcherConfig.parse_raw(config_json)
+
+
+async def run_in_thread(func, *args, **kwargs):
+    """
+    runs a blocking (ldap3) call in the default executor, so that the event loop can serve other fetchers.
+    same as `asyncio.to_thread()`, which is only available from python 3.9 on.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+class LdapConnectionPool:
+    """
+    Keeps bound ldap3 connections open between fetch events.
+
+    Connecting (including the TLS handshake for ldaps://) and binding is usually more expensive
+    than the search itself, and OPAL repeats the same fetches on every data update.
+    There is one pool per server and credentials, see `LdapConnectionPool.get()`.
+    """
+    # time of the last `close_idle()` run
+    _last_idle_check = 0.0
+
+    def __init__(self, connection_params: LdapConnectionParams, size: int = LDAP_POOL_SIZE) -> None:
+        self.key = self.key_of(connection_params)
+        self._connection_params = connection_params
+        self._server = ldap3.Server(host=connection_params.url, connect_timeout=LDAP_CONNECT_TIMEOUT)
+        self._size = size
+        # number of open connections, idle or in use
+        self._open = 0
+        # created on first use, so that they belong to the running event loop
+        self._slots: Optional[asyncio.Semaphore] = None
+        # (connection, time it was released), most recently used first,
+        # so that rarely needed connections can expire on the server
+        self._idle: Optional["asyncio.LifoQueue[Tuple[ldap3.Connection, float]]"] = None
+        # resolved when the connection that is currently being bound is ready, holds the error if the bind failed
+        self._connecting: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def key_of(connection_params: LdapConnectionParams) -> tuple:
+        # the password is part of the key, a connection bound with other credentials must never be reused
+        return connection_params.url, connection_params.user, connection_params.password
+
+    @classmethod
+    def get(cls, connection_params: LdapConnectionParams) -> "LdapConnectionPool":
+        key = cls.key_of(connection_params)
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = cls(connection_params)
+        return pool
+
+    @classmethod
+    async def close_idle(cls) -> None:
+        """
+        closes the connections of all pools that were idle for longer than `LDAP_POOL_MAX_IDLE`,
+        and forgets pools without open connections (i.e. of credentials that are not used anymore).
+        does nothing if it already ran within the last `LDAP_POOL_MAX_IDLE / 2` seconds.
+        """
+        now = time.monotonic()
+        if now - cls._last_idle_check < LDAP_POOL_MAX_IDLE / 2:
+            return
+        cls._last_idle_check = now
+        for key, pool in list(_POOLS.items()):
+            for connection in pool._take_idle_since(now - LDAP_POOL_MAX_IDLE):
+                await run_in_thread(cls._close, connection)
+            if not pool._open and _POOLS.get(key) is pool:
+                del _POOLS[key]
+
+    async def acquire(self) -> ldap3.Connection:
+        """
+        returns a bound connection, waits if `size` connections are already in use.
+        the connection must be handed back with `release()`.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._size)
+            self._idle = asyncio.LifoQueue()
+        await self._slots.acquire()
+        try:
+            while True:
+                if not self._idle.empty():
+                    connection, released_at = self._idle.get_nowait()
+                elif self._connecting is None:
+                    return await self._open_connection()
+                else:
+                    # when many fetches for the same server arrive at once (e.g. the data sources of one update),
+                    # only one of them binds at a time, the others take the first connection released by another
+                    # fetch, or bind the next one when the pending bind completes first (and fail if it failed)
+                    idle = await self._wait_for_release()
+                    if idle is None:
+                        continue
+                    connection, released_at = idle
+                if (time.monotonic() - released_at < LDAP_POOL_LIVENESS_CHECK_AFTER
+                        or await run_in_thread(self._is_alive, connection)):
+                    return connection
+                self._open -= 1
+                await run_in_thread(self._close, connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, connection: ldap3.Connection, discard: bool = False) -> None:
+        """
+        hands a connection back to the pool, it is closed instead if it is unusable or `discard` is set.
+        """
+        self._slots.release()
+        # a pool that was forgotten by `close_idle()` keeps no idle connections, nobody would close them
+        if discard or connection.closed or not connection.bound or _POOLS.get(self.key) is not self:
+            self._open -= 1
+            await run_in_thread(self._close, connection)
+        else:
+            self._idle.put_nowait((connection, time.monotonic()))
+
+    async def _open_connection(self) -> ldap3.Connection:
+        self._open += 1
+        connecting = self._connecting = asyncio.get_event_loop().create_future()
+        try:
+            return await run_in_thread(self._connect)
+        except Exception as e:
+            self._open -= 1
+            # the fetches waiting for this bind fail with it, binding again right away would only fail the same way
+            connecting.set_exception(e)
+            # marked as retrieved, asyncio would log it if no fetch was waiting
+            connecting.exception()
+            raise
+        except BaseException:
+            self._open -= 1
+            raise
+        finally:
+            self._connecting = None
+            if not connecting.done():
+                connecting.set_result(None)
+
+    async def _wait_for_release(self) -> Optional[Tuple[ldap3.Connection, float]]:
+        """
+        waits until another fetch releases a connection and returns it (with the time it was released),
+        returns None if the pending bind completes first, its connection belongs to the fetch that opened it.
+        raises the error of the pending bind if it failed.
+        """
+        connecting = self._connecting
+        getter = asyncio.ensure_future(self._idle.get())
+        try:
+            await asyncio.wait([getter, connecting], return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            # cancelled after the connection was taken from the queue, it must not get lost
+            if getter.done() and not getter.cancelled():
+                self._idle.put_nowait(getter.result())
+            raise
+        finally:
+            getter.cancel()
+        if getter.done() and not getter.cancelled():
+            return getter.result()
+        if connecting.exception() is not None:
+            raise connecting.exception()
+        return None
+
+    def _take_idle_since(self, released_before: float) -> List[ldap3.Connection]:
+        """
+        removes the idle connections released before `released_before` from the pool and returns them.
+        """
+        if self._idle is None:
+            return []
+        entries = []
+        while not self._idle.empty():
+            entries.append(self._idle.get_nowait())
+        # put back oldest first, so that the most recently used connection stays on top
+        for entry in reversed(entries):
+            if entry[1] >= released_before:
+                self._idle.put_nowait(entry)
+        stale = [connection for connection, released_at in entries if released_at < released_before]
+        self._open -= len(stale)
+        return stale
+
+    def _connect(self) -> ldap3.Connection:
+        connection_params = self._connection_params
+        # pooled connections idle between fetches and may be closed by the server in the meantime,
+        # the restartable strategy reopens and rebinds them transparently
+        connection = ldap3.Connection(
+            server=self._server,
+            user=connection_params.user,
+            password=connection_params.password,
+            client_strategy=ldap3.RESTARTABLE,
+            receive_timeout=LDAP_RECEIVE_TIMEOUT,
+            auto_range=True,
+            read_only=True,
+        )
+        # ldap3 defaults to 30 tries, which would block the worker thread for a minute on an unreachable server
+        connection.strategy.restartable_tries = LDAP_RESTARTABLE_TRIES
+        if not connection.bind():
+            result = connection.result
+            # like auto_bind does, the opened socket must not be left behind
+            self._close(connection)
+            raise LDAPBindError(f"could not bind to {connection_params.url}: {result}")
+        # ldap3.Server takes no socket options, the socket of the bound connection is configured directly
+        connection.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            # the system default waits two hours before the first probe
+            connection.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, LDAP_KEEPALIVE_IDLE)
+        return connection
+
+    @staticmethod
+    def _is_alive(connection: ldap3.Connection) -> bool:
+        sock = connection.socket
+        try:
+            # bounded, the check of a connection that was dropped silently would otherwise block until tcp gives up
+            if sock is not None:
+                sock.settimeout(LDAP_POOL_LIVENESS_CHECK_TIMEOUT)
+            # reading the root DSE is cheap and allowed for every bound user
+            return connection.search("", "(objectclass=*)", search_scope=ldap3.BASE, attributes=[])
+        except LDAPException:
+            return False
+        finally:
+            if sock is not None and sock is connection.socket:
+                sock.settimeout(connection.receive_timeout)
+
+    @staticmethod
+    def _close(connection: ldap3.Connection) -> None:
+        try:
+            # unbind: disconnect and close the connection
+            connection.unbind()
+        except LDAPException as e:
+            logger.debug(f"could not unbind stale ldap connection: {e}")
+
+
+_POOLS: Dict[tuple, LdapConnectionPool] = {}
+
+# search results by (pool key, root dn, search query, attributes):
+# (time the search started, cache_ttl_seconds of the fetch that started it, future of the values)
+# a future of None means that the search failed, and every waiting fetch has to search on its own
+_SEARCH_CACHE: Dict[tuple, Tuple[float, float, asyncio.Future]] = {}
+SEARCH_CACHE_SIZE = 256
+
+# result codes of a search that ended early, its result is incomplete
+_RESULT_LIMITED = (RESULT_SIZE_LIMIT_EXCEEDED, RESULT_ADMIN_LIMIT_EXCEEDED)
+# result code of a paged search that ended early, because the server does not allow pages this large,
+# sizeLimitExceeded is the overall limit of the server, smaller pages do not help with it
+_PAGED_SIZE_REJECTED = RESULT_ADMIN_LIMIT_EXCEEDED
+# the paged size is not halved below this
+_MIN_PAGED_SIZE = 100
+
+
 class LdapFetchProvider(BaseFetchProvider):
     """
     An OPAL fetch provider for ldap.
@@ -86,19 +405,28 @@ class LdapFetchProvider(BaseFetchProvider):
     RETRY_CONFIG = {
         'wait': wait.wait_random_exponential(),
         'stop': stop.stop_after_attempt(10),
-        # 'retry': retry_unless_exception_type(SomeError), # query error (i.e: invalid table, etc)
+        # a malformed search filter will not be fixed by retrying
+        'retry': retry_if_exception(lambda e: not isinstance(e, LDAPInvalidFilterError)),
         'reraise': True
     }
 
     def __init__(self, event: LdapFetchEvent) -> None:
         if event.config is None:
             event.config = LdapFetcherConfig()
-        super().__init__(event)
-        self._server: Optional[ldap3.Server] = None
-        self._connection: Optional[ldap3.Connection] = None
+        # without retry_config, BaseFetchProvider uses its DEFAULT_RETRY_CONFIG (200 attempts)
+        super().__init__(event, retry_config=self.RETRY_CONFIG)
+        self._pool: Optional[LdapConnectionPool] = None
 
     def parse_event(self, event: FetchEvent) -> LdapFetchEvent:
-        return LdapFetchEvent(**event.dict(exclude={"config"}), config=event.config)
+        if LDAP_VALIDATE_FETCH_EVENTS:
+            return LdapFetchEvent(**event.dict(exclude={"config"}), config=event.config)
+        # the fields of the FetchEvent are already validated, only the config (a plain dict) still has to be parsed
+        config = event.config
+        if isinstance(config, dict):
+            config = _parse_fetcher_config(json.dumps(config, sort_keys=True))
+        elif not isinstance(config, LdapFetcherConfig):
+            config = LdapFetcherConfig.parse_obj(config)
+        return LdapFetchEvent.construct(**dict(zip(_EVENT_FIELDS, _get_event_fields(event))), config=config)
 
     async def __aenter__(self):
         self._event: LdapFetchEvent  # type casting
@@ -106,27 +434,13 @@ class LdapFetchProvider(BaseFetchProvider):
         dsn: str = self._event.url
         connection_params = self._event.config.connection_params
 
-        # connect to the Ldap database
+        # the connections to the Ldap database are taken from the pool for each search, see `_search()`
         connection_params: LdapConnectionParams
-        self._server = ldap3.Server(host=connection_params.url)
-        self._connection = ldap3.Connection(
-            server=self._server,
-            user=connection_params.user,
-            password=connection_params.password,
-            auto_bind=True,
-            auto_range=True,
-            read_only=True,
-        )
-        # TODO use a threadpoolexecutor for this?
-        self._connection.open()
+        await LdapConnectionPool.close_idle()
+        self._pool = LdapConnectionPool.get(connection_params)
 
         return self
 
-    async def __aexit__(self, exc_type=None, exc_val=None, tb=None):
-        if self._connection is not None:
-            # unbind: disconnect and close the connection
-            self._connection.unbind()
-
     async def _fetch_(self):
         self._event: LdapFetchEvent  # type casting
 
@@ -136,30 +450,134 @@ class LdapFetchProvider(BaseFetchProvider):
             return
 
         logger.debug(f"{self.__class__.__name__} fetching from {self._url}")
-        root_dn = self._event.config.root
-        search_query = self._event.config.search
-        attributes = self._event.config.attributes
+        config = self._event.config
+        searches = [(search.root, search.search, search.attributes) for search in config.searches or ()]
+        if config.search is not None:
+            searches.insert(0, (config.root, config.search, config.attributes))
+        if len(searches) == 1:
+            return await self._cached_search(*searches[0])
+
+        # every search runs on its own pooled connection, so that they overlap instead of adding up
+        results = await asyncio.gather(*(self._cached_search(*search) for search in searches))
+        values = {}
+        for result in results:
+            for dn, attributes in result.items():
+                # copied, cached results are shared and must not be modified
+                values.setdefault(dn, {}).update(attributes)
+        return values
+
+    async def _cached_search(self, root_dn: str, search_query: str, attributes: List[str]) -> Dict[str, Dict]:
+        """
+        returns the entries found by the search, possibly from an identical search of another fetch,
+        see `LdapFetcherConfig.cache_ttl_seconds`.
+        """
+        cache_ttl = self._event.config.cache_ttl_seconds
+        if not cache_ttl:
+            values, _ = await self._search_all(root_dn, search_query, attributes)
+            return values
+
+        # OPAL fetches on policy and data updates, not when the directory changes,
+        # so identical searches are repeated often
+        key = (self._pool.key, root_dn, search_query, tuple(attributes))
+        now = time.monotonic()
+        cached = _SEARCH_CACHE.get(key)
+        # the age is checked against the ttl of this fetch, not of the one that stored the result
+        if cached is not None and now - cached[0] < cache_ttl:
+            # shielded, the search may be shared by several fetches
+            values = await asyncio.shield(cached[2])
+            if values is not None:
+                return values
+        future = asyncio.get_event_loop().create_future()
+        # results that expired for the fetch that stored them are not kept in memory any longer
+        for expired in [k for k, (started, ttl, _) in _SEARCH_CACHE.items() if now - started >= ttl]:
+            del _SEARCH_CACHE[expired]
+        _SEARCH_CACHE.pop(key, None)
+        _SEARCH_CACHE[key] = (now, cache_ttl, future)
+        if len(_SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+            # dicts are ordered by insertion, so this is the oldest entry
+            del _SEARCH_CACHE[next(iter(_SEARCH_CACHE))]
+        values, complete = None, False
+        try:
+            values, complete = await self._search_all(root_dn, search_query, attributes)
+        finally:
+            # failed and incomplete searches are not reused by later fetches
+            if not complete and _SEARCH_CACHE.get(key, (None, None, None))[2] is future:
+                del _SEARCH_CACHE[key]
+            future.set_result(values)
+        return values
+
+    async def _search_all(self, root_dn: str, search_query: str,
+                          attributes: List[str]) -> Tuple[Dict[str, Dict], bool]:
+        """
+        returns all entries found by the search, and whether the server returned all of them.
+        retries with smaller pages if the server rejects the page size.
+        """
+        paged_size = self._event.config.paged_size
         # This should also support MS AD with 1000+ entries
-        return self._connection.extend.standard.paged_search(
-            search_base=root_dn,
-            search_filter=search_query,
-            attributes=attributes,
-            paged_size=100,
-        )
+        while True:
+            values, result = await self._search(root_dn, search_query, attributes, paged_size)
+            if result == _PAGED_SIZE_REJECTED and paged_size > _MIN_PAGED_SIZE:
+                paged_size = max(paged_size // 2, _MIN_PAGED_SIZE)
+                logger.info(f"{self.__class__.__name__} retrying search with paged_size={paged_size}")
+                continue
+            if result in _RESULT_LIMITED:
+                logger.warning(f"{self.__class__.__name__} search was limited by {self._url}, the result is incomplete")
+                return values, False
+            return values, True
 
-    async def _process_(self, records: List[Dict]):
-        self._event: LdapFetchEvent  # type casting
-        attributes = self._event.config.attributes
-        # we transform the asyncpg records to a list-of-dicts that we can be later serialized to json
-        values = {
-            (dn := record)["dn"]:
-                {
-                    attribute:
-                        record["attributes"][attribute]
-                    for attribute in attributes
-                    if attribute in record["attributes"]
-                }
-            for record in records
-            if record["type"] == "searchResEntry"}
-        logger.info(json.dumps(values))
+    async def _search(self, root_dn: str, search_query: str, attributes: List[str],
+                      paged_size: int) -> Tuple[Dict[str, Dict], Optional[int]]:
+        """
+        returns the transformed entries and the ldap result code of the last page.
+        """
+        connection = await self._pool.acquire()
+        search = asyncio.ensure_future(run_in_thread(
+            self._search_entries, connection, root_dn, search_query, attributes, paged_size))
+        try:
+            # shielded, the search thread keeps using the connection until it is done, even if this fetch is cancelled
+            return await asyncio.shield(search)
+        finally:
+            await asyncio.wait([search])
+            # a connection that failed during the search might be in an undefined state
+            await self._pool.release(connection, discard=search.cancelled() or search.exception() is not None)
+
+    @staticmethod
+    def _search_entries(connection: ldap3.Connection, root_dn: str, search_query: str, attributes: List[str],
+                        paged_size: int) -> Tuple[Dict[str, Dict], Optional[int]]:
+        """
+        runs in a worker thread: performs the paged search and transforms the entries to `{dn: {attribute: value}}`.
+        returns the entries and the ldap result code of the last page.
+        """
+        wanted = tuple(attributes)
+        # "*" or "+" requested: keep everything the server returned
+        wildcard = ldap3.ALL_ATTRIBUTES in wanted or ldap3.ALL_OPERATIONAL_ATTRIBUTES in wanted
+        values = {}
+        # paged_search returns a generator that sends the follow-up page requests lazily,
+        # so only one page of raw ldap3 records is kept in memory at a time
+        for record in connection.extend.standard.paged_search(
+                search_base=root_dn,
+                search_filter=search_query,
+                attributes=attributes,
+                paged_size=paged_size,
+        ):
+            if record["type"] != "searchResEntry":
+                continue
+            if wildcard:
+                values[record["dn"]] = dict(record["attributes"])
+                continue
+            # a single lookup per attribute, instead of `in` followed by `[]`
+            get_attribute = record["attributes"].get
+            values[record["dn"]] = {
+                attribute: value
+                for attribute in wanted
+                if (value := get_attribute(attribute)) is not None
+            }
+        return values, (connection.result or {}).get("result")
+
+    async def _process_(self, values: Dict[str, Dict]):
+        # the records were already transformed to a dict-of-dicts (dn -> attributes) while fetching,
+        # which can later be serialized to json
+        logger.info(f"{self.__class__.__name__} fetched {len(values)} entries from {self._url}")
+        # lazy: the (possibly huge) json dump is only created if debug logging is enabled
+        logger.opt(lazy=True).debug("{}", lambda: json.dumps(values))
         return values
@@ -0,0 +1,278 @@
+"""
+Tests for the LdapFetchProvider, run against an in-memory directory (ldap3's MOCK_SYNC strategy).
+"""
+import asyncio
+import time
+
+import ldap3
+import pydantic
+import pytest
+from ldap3.core.exceptions import LDAPBindError, LDAPInvalidFilterError
+from ldap3.core.results import RESULT_ADMIN_LIMIT_EXCEEDED, RESULT_SIZE_LIMIT_EXCEEDED
+from opal_common.fetcher.events import FetchEvent
+
+from opal_fetcher_ldap import provider
+
+CONNECTION_PARAMS = {"url": "ldap://mock", "user": "cn=admin,dc=example", "password": "secret"}
+
+
+def mock_connect(pool: provider.LdapConnectionPool) -> ldap3.Connection:
+    connection = ldap3.Connection(ldap3.Server("mock"), user="cn=admin,dc=example", password="secret",
+                                  client_strategy=ldap3.MOCK_SYNC)
+    connection.strategy.add_entry("cn=admin,dc=example", {"objectClass": "person", "userPassword": "secret"})
+    connection.strategy.add_entry("cn=user,dc=example", {"objectClass": "person", "cn": "user", "mail": "user@example"})
+    connection.strategy.add_entry("cn=other,dc=example", {"objectClass": "person", "cn": "other"})
+    connection.bind()
+    return connection
+
+
+@pytest.fixture(autouse=True)
+def mock_directory(monkeypatch):
+    monkeypatch.setattr(provider.LdapConnectionPool, "_connect", mock_connect)
+    # every test runs its own event loop, pools and cached searches must not outlive it
+    monkeypatch.setattr(provider, "_POOLS", {})
+    monkeypatch.setattr(provider, "_SEARCH_CACHE", {})
+
+
+@pytest.fixture
+def searches(monkeypatch) -> list:
+    """
+    the searches sent to the directory, as (root dn, search query, paged size).
+    """
+    sent = []
+    search_once = provider.LdapFetchProvider._search
+
+    async def counted_search(self, root_dn, search_query, attributes, paged_size):
+        sent.append((root_dn, search_query, paged_size))
+        return await search_once(self, root_dn, search_query, attributes, paged_size)
+
+    monkeypatch.setattr(provider.LdapFetchProvider, "_search", counted_search)
+    return sent
+
+
+def make_event(search: str = "(cn=user)", **config) -> FetchEvent:
+    return FetchEvent(fetcher="LdapFetchProvider", url="ldap://mock", config={
+        "fetcher": "LdapFetchProvider",
+        "root": "dc=example",
+        "search": search,
+        "attributes": ["cn", "mail"],
+        "connection_params": CONNECTION_PARAMS,
+        **config,
+    })
+
+
+async def fetch_async(search: str = "(cn=user)", **config):
+    async with provider.LdapFetchProvider(make_event(search, **config)) as fetcher:
+        return await fetcher.process(await fetcher.fetch())
+
+
+def fetch(search: str = "(cn=user)", **config):
+    return asyncio.run(fetch_async(search, **config))
+
+
+def test_fetch():
+    assert fetch("(cn=user)") == {"cn=user,dc=example": {"cn": ["user"], "mail": ["user@example"]}}
+
+
+def test_fetch_all_attributes():
+    assert fetch("cn=user", attributes=None) == {
+        "cn=user,dc=example": {"objectClass": ["person"], "cn": ["user"], "mail": ["user@example"]}}
+
+
+def test_invalid_filter_is_not_retried(monkeypatch):
+    attempts = []
+    fetch_once = provider.LdapFetchProvider._fetch_
+
+    async def counted_fetch(self):
+        attempts.append(self)
+        return await fetch_once(self)
+
+    monkeypatch.setattr(provider.LdapFetchProvider, "_fetch_", counted_fetch)
+    with pytest.raises(LDAPInvalidFilterError):
+        fetch("(cn=user")
+    assert len(attempts) == 1
+
+
+def test_parse_event():
+    event = provider.LdapFetchProvider(make_event())._event
+    assert isinstance(event, provider.LdapFetchEvent)
+    assert isinstance(event.config, provider.LdapFetcherConfig)
+    assert event.url == "ldap://mock"
+    assert event.config.search == "(cn=user)"
+    assert event.config.connection_params.url == "ldap://mock"
+    # identical configs are parsed only once
+    assert provider.LdapFetchProvider(make_event())._event.config is event.config
+
+
+def test_searches_are_merged():
+    values = fetch("(cn=user)", attributes=["cn"], searches=[
+        {"root": "dc=example", "search": "(cn=user)", "attributes": ["mail"]},
+        {"root": "dc=example", "search": "(cn=other)", "attributes": ["cn"]},
+    ])
+    assert values == {
+        "cn=user,dc=example": {"cn": ["user"], "mail": ["user@example"]},
+        "cn=other,dc=example": {"cn": ["other"]},
+    }
+
+
+def test_searches_require_root_and_search():
+    with pytest.raises(pydantic.ValidationError):
+        provider.LdapFetcherConfig.parse_obj({"searches": [{"root": "dc=example"}]})
+    with pytest.raises(pydantic.ValidationError):
+        provider.LdapFetcherConfig.parse_obj({"searches": [{"search": "(cn=user)"}]})
+
+
+def limit_searches(monkeypatch, result_of_paged_size) -> list:
+    """
+    replaces the directory by one that ends every search with `result_of_paged_size(paged_size)`,
+    returns the paged sizes of the searches sent to it.
+    """
+    paged_sizes = []
+
+    async def limited_search(self, root_dn, search_query, attributes, paged_size):
+        paged_sizes.append(paged_size)
+        return {"cn=user,dc=example": {"cn": ["user"]}}, result_of_paged_size(paged_size)
+
+    monkeypatch.setattr(provider.LdapFetchProvider, "_search", limited_search)
+    return paged_sizes
+
+
+def test_rejected_page_size_is_halved(monkeypatch):
+    paged_sizes = limit_searches(monkeypatch, lambda size: RESULT_ADMIN_LIMIT_EXCEEDED if size > 250 else 0)
+    fetch(paged_size=1000)
+    assert paged_sizes == [1000, 500, 250]
+
+
+def test_size_limit_is_not_retried_with_smaller_pages(monkeypatch):
+    paged_sizes = limit_searches(monkeypatch, lambda size: RESULT_SIZE_LIMIT_EXCEEDED)
+    assert fetch(paged_size=1000) == {"cn=user,dc=example": {"cn": ["user"]}}
+    assert paged_sizes == [1000]
+
+
+def test_cached_search_is_reused(searches):
+    async def run():
+        return await fetch_async(cache_ttl_seconds=600), await fetch_async(cache_ttl_seconds=600)
+
+    first, second = asyncio.run(run())
+    assert first == second == {"cn=user,dc=example": {"cn": ["user"], "mail": ["user@example"]}}
+    assert len(searches) == 1
+
+
+def test_concurrent_identical_searches_are_shared(searches):
+    async def run():
+        return await asyncio.gather(*(fetch_async(cache_ttl_seconds=600) for _ in range(3)))
+
+    assert len({str(values) for values in asyncio.run(run())}) == 1
+    assert len(searches) == 1
+
+
+def test_cached_search_is_checked_against_the_ttl_of_the_reader(searches):
+    async def run():
+        await fetch_async(cache_ttl_seconds=600)
+        await asyncio.sleep(0.1)
+        await fetch_async(cache_ttl_seconds=0.05)
+        await fetch_async(cache_ttl_seconds=600)
+
+    asyncio.run(run())
+    assert len(searches) == 2
+
+
+def test_failed_search_is_not_shared(monkeypatch):
+    calls = []
+    search_once = provider.LdapFetchProvider._search
+
+    async def failing_search(self, root_dn, search_query, attributes, paged_size):
+        calls.append(self)
+        if len(calls) == 1:
+            # still running when the second fetch arrives, and not retried
+            await asyncio.sleep(0.05)
+            raise LDAPInvalidFilterError("invalid filter")
+        return await search_once(self, root_dn, search_query, attributes, paged_size)
+
+    monkeypatch.setattr(provider.LdapFetchProvider, "_search", failing_search)
+
+    async def run():
+        return await asyncio.gather(*(fetch_async(cache_ttl_seconds=600) for _ in range(2)), return_exceptions=True)
+
+    failed, values = asyncio.run(run())
+    assert isinstance(failed, LDAPInvalidFilterError)
+    assert values == {"cn=user,dc=example": {"cn": ["user"], "mail": ["user@example"]}}
+    assert len(calls) == 2
+
+
+def test_incomplete_search_is_not_cached(monkeypatch):
+    paged_sizes = limit_searches(monkeypatch, lambda size: RESULT_SIZE_LIMIT_EXCEEDED)
+
+    async def run():
+        await fetch_async(cache_ttl_seconds=600)
+        await fetch_async(cache_ttl_seconds=600)
+
+    asyncio.run(run())
+    assert len(paged_sizes) == 2
+    assert not provider._SEARCH_CACHE
+
+
+def test_concurrent_fetches_share_connections(monkeypatch):
+    binds = []
+
+    def slow_connect(pool):
+        binds.append(pool)
+        time.sleep(0.05)
+        return mock_connect(pool)
+
+    monkeypatch.setattr(provider.LdapConnectionPool, "_connect", slow_connect)
+    pool = provider.LdapConnectionPool.get(provider.LdapConnectionParams(**CONNECTION_PARAMS))
+
+    async def use():
+        connection = await pool.acquire()
+        await asyncio.sleep(0.01)
+        await pool.release(connection)
+
+    async def run():
+        await asyncio.gather(*(use() for _ in range(5)))
+
+    asyncio.run(run())
+    assert len(binds) < 5
+    assert pool._open == len(binds) == pool._idle.qsize()
+
+
+def test_failed_bind_fails_the_waiting_fetches(monkeypatch):
+    binds = []
+
+    def failing_connect(pool):
+        binds.append(pool)
+        time.sleep(0.05)
+        raise LDAPBindError("invalid credentials")
+
+    monkeypatch.setattr(provider.LdapConnectionPool, "_connect", failing_connect)
+    pool = provider.LdapConnectionPool.get(provider.LdapConnectionParams(**CONNECTION_PARAMS))
+
+    async def run():
+        return await asyncio.gather(*(pool.acquire() for _ in range(3)), return_exceptions=True)
+
+    assert all(isinstance(error, LDAPBindError) for error in asyncio.run(run()))
+    assert len(binds) == 1
+    assert pool._open == 0
+    assert pool._slots._value == provider.LDAP_POOL_SIZE
+
+
+def test_close_idle(monkeypatch):
+    connections = []
+
+    def recorded_connect(pool):
+        connections.append(mock_connect(pool))
+        return connections[-1]
+
+    monkeypatch.setattr(provider.LdapConnectionPool, "_connect", recorded_connect)
+    monkeypatch.setattr(provider, "LDAP_POOL_MAX_IDLE", 0.05)
+    monkeypatch.setattr(provider.LdapConnectionPool, "_last_idle_check", 0.0)
+
+    async def run():
+        await fetch_async()
+        await asyncio.sleep(0.1)
+        await provider.LdapConnectionPool.close_idle()
+
+    asyncio.run(run())
+    assert len(connections) == 1
+    assert connections[0].closed
+    assert not provider._POOLS